@@ -9,16 +9,17 @@ from datetime import datetime
 import os
 import json
 import logging
+import signal
 import sys
+import threading
 import time
-from watchdog.observers import Observer
-from watchdog.events import PatternMatchingEventHandler
-import yaml
 import re
 
+from concurrent.futures import ThreadPoolExecutor, wait
+from itertools import chain
 from tempfile import NamedTemporaryFile
 from pathlib import Path
-from typing import Optional
+from typing import IO, TYPE_CHECKING, Iterator, Optional
 from dotenv import load_dotenv
 from rich.console import Console
 from rich.logging import RichHandler
@@ -26,7 +27,7 @@ from pick import pick
 
 _logger = logging.getLogger('garmin')
 
-# fit_tool configures logging for itself, so need to do this before importing it
+# fit_tool configures logging for itself, so need to do this before it is first imported
 logging.basicConfig(
     level=logging.NOTSET, format="%(message)s", datefmt="[%X]", handlers=[RichHandler(markup=True)]
 )
@@ -35,20 +36,20 @@ _logger.setLevel(logging.INFO)
 logging.getLogger('urllib3.connectionpool').setLevel(logging.WARNING)
 logging.getLogger('oauth1_auth').setLevel(logging.WARNING)
 
-from fit_tool.fit_file import FitFile
-from fit_tool.profile.messages.device_info_message import DeviceInfoMessage
-from fit_tool.profile.messages.file_id_message import FileIdMessage
-from fit_tool.profile.profile_type import Manufacturer, GarminProduct
-from fit_tool.fit_file_builder import FitFileBuilder
-
+# fit_tool, garth and watchfiles are slow to import, so they are imported in the functions that use them
+if TYPE_CHECKING:
+    from fit_tool.record import Record
+    from watchfiles import Change
 
 load_dotenv()
 c = Console()
 
-EDGE830 = GarminProduct.EDGE_830
-GARMIN = Manufacturer.GARMIN
 FILES_UPLOADED_NAME = Path('.uploaded_files.json')
 CONFIG_FILE = Path('.config')
+TPV_ID_RE = re.compile(r'\A\w{16}\Z')
+MAX_UPLOAD_WORKERS = 4
+# Garmin Connect throttles clients making more than ~100 requests a minute
+UPLOAD_INTERVAL = 60 / 100
 
 class FitFileLogFilter(logging.Filter):
     """Filter to remove specific warning from the fit_tool module"""
@@ -57,18 +58,14 @@ class FitFileLogFilter(logging.Filter):
         return res
 logging.getLogger('fit_tool').addFilter(FitFileLogFilter())
 
-class NewFileEventHandler(PatternMatchingEventHandler):
-    def __init__(self):
-        PatternMatchingEventHandler.__init__(self, patterns=['*.fit'],
-                                                             ignore_directories=True, case_sensitive=False)
-    def on_created(self, event) -> None:
-        _logger.debug("New file created - % s." % event.src_path)
-        # Wait for a short time to make sure TPV has finished writing to the file
-        time.sleep(5)
-        # Run the upload all function
-        upload_all(Path(event.src_path).parent.absolute())
+def new_fit_file_filter(change: 'Change', path: str) -> bool:
+    from watchfiles import Change
+
+    return change == Change.added and path.lower().endswith('.fit')
 
 def print_message(prefix, message):
+    from fit_tool.profile.profile_type import Manufacturer, GarminProduct
+
     man = Manufacturer(message.manufacturer).name if message.manufacturer in Manufacturer else "BLANK"
     gar_prod = GarminProduct(message.garmin_product) if message.garmin_product in GarminProduct else "BLANK"
     _logger.debug(f"{prefix} - manufacturer: {message.manufacturer} (\"{man}\") - "
@@ -77,7 +74,8 @@ def print_message(prefix, message):
 def first_run():
     _logger.info(f"Running first time setup")
     TPVPath = get_tpv_folder()
-    res = [f for f in os.listdir(TPVPath) if re.search(r'\A(\w){16}\Z', f)]
+    with os.scandir(TPVPath) as entries:
+        res = [e.name for e in entries if e.is_dir(follow_symlinks=False) and TPV_ID_RE.match(e.name)]
     if len(res) == 0:
         _logger.error('Cannot find a TP Virtual User folder in %s, please check if you have previously logged into TP Virtual', TPVPath)
         sys.exit(1)
@@ -87,7 +85,7 @@ def first_run():
         if option == 'no':
             _logger.error('First setup failed to find correct TP Virtual User folder please manually configure TPV_ID in config file: %s', CONFIG_FILE.absolute())
             with CONFIG_FILE.open('w') as f:
-                yaml.dump({'TPV_ID': ''},f)
+                json.dump({'TPV_ID': ''}, f)
             sys.exit(1)
         else:
             index=0
@@ -97,7 +95,7 @@ def first_run():
     TPVIDPath = Path(TPVPath).joinpath(res[index])
     _logger.info(f"Found TP Virtual User directory: {str(TPVIDPath.absolute())}, setting TPV_ID key in config file")
     with CONFIG_FILE.open('w') as f:
-        yaml.dump({'TPV_ID': res[index]},f)
+        json.dump({'TPV_ID': res[index]}, f)
 
     email = os.environ.get('GARMIN_USERNAME', None)
     password = os.environ.get('GARMIN_PASSWORD', None)
@@ -114,6 +112,16 @@ def first_run():
                 f.write(envFileContents)
             _logger.info(f"Stored Garmin credentials in {str(Path('.env').absolute())}")
 
+def load_config() -> dict:
+    with CONFIG_FILE.open('r') as f:
+        contents = f.read()
+    try:
+        return json.loads(contents)
+    except json.JSONDecodeError:
+        # config files written by older versions of this tool are YAML
+        import yaml
+        return yaml.safe_load(contents)
+
 def get_tpv_folder() -> Path:
     if sys.platform == "darwin":
         TPVPath = os.path.expanduser('~/TPVirtual')
@@ -124,42 +132,97 @@ def get_tpv_folder() -> Path:
         _logger.info(f"This tool is currently only tested for Windows/OSX, your TrainingPeaks Virtual user folder may not be found")
     return Path(TPVPath)
 
-def get_date_from_fit(fit_path: Path) -> Optional[datetime]:
-    fit_file = FitFile.from_file(str(fit_path))
-    res = None
-    for i, record in enumerate(fit_file.records):
+def iter_fit_records(fit_path: Path) -> Iterator['Record']:
+    """Yield the records of a FIT file as they are decoded, instead of building FitFile's full record list"""
+    # the input crc is not verified, the records are always rebuilt and FitFileBuilder calculates a new one
+    from fit_tool.base_type import BaseType
+    from fit_tool.developer_field import DeveloperField
+    from fit_tool.fit_file_header import FitFileHeader
+    from fit_tool.profile.messages.field_description_message import FieldDescriptionMessage
+    from fit_tool.record import Record
+
+    with fit_path.open('rb') as f:
+        bytes_buffer = f.read()
+
+    header_size = bytes_buffer[0]
+    header_bytes = bytes_buffer[:header_size]
+    header = FitFileHeader.from_bytes(header_bytes)
+    offset = header_size
+    records_end = header_size + header.records_size
+
+    definition_messages = {}
+    developer_fields_by_data_index = {}
+    while offset < records_end:
+        record = Record.from_bytes(definition_messages=definition_messages, bytes_buffer=bytes_buffer,
+                                   offset=offset, developer_fields_by_data_index=developer_fields_by_data_index)
         message = record.message
-        if message.global_id == FileIdMessage.ID:
-            if isinstance(message, FileIdMessage):
-                res = datetime.fromtimestamp(message.time_created/1000.0) # type: ignore
-                break
-    return res
-
-def edit_fit(fit_path: Path, output: Optional[Path] = None, dryrun: bool = False) -> Path:
-    fit_file = FitFile.from_file(str(fit_path))
-    if not output:
-        output = fit_path.parent / f"{fit_path.stem}_modified.fit"
+        if record.is_definition:
+            definition_messages[record.local_id] = message
+        elif isinstance(message, FieldDescriptionMessage):
+            developer_field = DeveloperField(developer_data_index=message.developer_data_index,
+                                             field_id=message.field_definition_number,
+                                             base_type=BaseType(message.fit_base_type_id),
+                                             name=message.field_name,
+                                             scale=message.scale,
+                                             offset=message.offset,
+                                             units=message.units)
+            developer_fields_by_data_index.setdefault(developer_field.developer_data_index, {})[
+                developer_field.field_id] = developer_field
+
+        defined_size = record.defined_size(definition_messages[record.local_id])
+        if record.size != defined_size:
+            _logger.warning(f"Record {message}: size ({record.size}) != defined size ({defined_size}). "
+                            "Some fields were not read correctly.")
+        offset += defined_size
+        yield record
+
+def build_modified_fit(fit_path: Path, require_file_id: bool = False) -> tuple[Optional[bytes], Optional[datetime]]:
+    from fit_tool.fit_file_builder import FitFileBuilder
+    from fit_tool.profile.messages.device_info_message import DeviceInfoMessage
+    from fit_tool.profile.messages.file_id_message import FileIdMessage
+    from fit_tool.profile.profile_type import Manufacturer, GarminProduct
 
     builder = FitFileBuilder(auto_define=True)
     dt = None
-    # loop through records, find the one we need to change, and modify the values:
-    for i, record in enumerate(fit_file.records):
+    # bind names used for every record to locals, these loops run once per record in the file
+    add = builder.add
+    file_id_id = FileIdMessage.ID
+    device_info_id = DeviceInfoMessage.ID
+    # loop through records, find the ones we need to change, and modify the values
+    records = enumerate(iter_fit_records(fit_path))
+
+    # the FIT protocol requires the file id to be the first data message, so only check that one
+    for i, record in records:
         message = record.message
-        
+        if record.is_definition:
+            add(message)
+            continue
+
         # change file id to indicate file was saved by Edge 830
-        if message.global_id == FileIdMessage.ID:
-            if isinstance(message, FileIdMessage):
-                dt = datetime.fromtimestamp(message.time_created/1000.0)   # type: ignore
-                _logger.info(f"Activity timestamp is \"{dt.isoformat()}\"")
-                print_message(f"Record: {i}", message)
-                if message.manufacturer == Manufacturer.DEVELOPMENT.value:
-                    _logger.debug('    Modifying values')
-                    message.product = GarminProduct.EDGE_830.value
-                    message.manufacturer = Manufacturer.GARMIN.value
-                    print_message(f"    New Record: {i}", message)
-        
+        if message.global_id == file_id_id and isinstance(message, FileIdMessage):
+            dt = datetime.fromtimestamp(message.time_created/1000.0)   # type: ignore
+            _logger.info(f"Activity timestamp is \"{dt.isoformat()}\"")
+            print_message(f"Record: {i}", message)
+            if message.manufacturer == Manufacturer.DEVELOPMENT.value:
+                _logger.debug('    Modifying values')
+                message.product = GarminProduct.EDGE_830.value
+                message.manufacturer = Manufacturer.GARMIN.value
+                print_message(f"    New Record: {i}", message)
+            add(message)
+        elif require_file_id:
+            # don't decode the rest of a file that can't be uploaded
+            return None, None
+        else:
+            # no file id, so this record goes through the device info loop like the rest
+            records = chain([(i, record)], records)
+        break
+
+    # device info messages may appear anywhere in the rest of the file
+    for i, record in records:
+        message = record.message
+
         # change device info messages
-        if message.global_id == DeviceInfoMessage.ID:
+        if message.global_id == device_info_id:
             if isinstance(message, DeviceInfoMessage):
                 print_message(f"Record: {i}", message)
                 if message.manufacturer == Manufacturer.DEVELOPMENT.value or message.manufacturer == 0 or message.manufacturer == Manufacturer.WAHOO_FITNESS.value:
@@ -169,18 +232,50 @@ def edit_fit(fit_path: Path, output: Optional[Path] = None, dryrun: bool = False
                     message.manufacturer = Manufacturer.GARMIN.value
                     print_message(f"    New Record: {i}", message)
 
-        builder.add(message)
+        add(message)
+
+    return builder.build().to_bytes(), dt
 
-    modified_file = builder.build()
+def edit_fit(fit_path: Path, output: Optional[Path] = None, dryrun: bool = False) -> tuple[Path, Optional[datetime]]:
+    if not output:
+        output = fit_path.parent / f"{fit_path.stem}_modified.fit"
+
+    data, dt = build_modified_fit(fit_path)
     _logger.info(f"Saving modified data to \"{output}\"")
     if not dryrun:
-        modified_file.to_file(str(output))
-    return output
+        output.write_bytes(data)
+    return output, dt
     
-def upload(fn: Path, original_path: Optional[Path] = None, dryrun: bool = False):
-    # get credentials and login if needed
+class RateLimiter:
+    """Spaces out calls made from any thread so they are at least `interval` seconds apart"""
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._next = 0.0
+
+    def wait(self) -> None:
+        with self._lock:
+            now = time.monotonic()
+            delay = self._next - now
+            self._next = max(now, self._next) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+upload_limiter = RateLimiter(UPLOAD_INTERVAL)
+_garth_ready = False
+_garth_lock = threading.Lock()
+
+def _ensure_garth():
+    # get credentials and login if needed, only once per process unless the session stops working
+    with _garth_lock:
+        _login_garth()
+
+def _login_garth():
+    global _garth_ready
+    if _garth_ready:
+        return
     import garth
-    from garth.exc import GarthException, GarthHTTPError
+    from garth.exc import GarthException
 
     try:
         garth.resume(".garth")
@@ -201,19 +296,63 @@ def upload(fn: Path, original_path: Optional[Path] = None, dryrun: bool = False)
             _logger.debug("Using password stored in \"GARMIN_PASSWORD\"")
         garth.login(email, password)
         garth.save(".garth")
-        
+    _garth_ready = True
+
+def upload(fn: Path, original_path: Optional[Path] = None, dryrun: bool = False):
     with fn.open('rb') as f:
-        try:
-            if not dryrun:
+        return upload_file(f, original_path=original_path, dryrun=dryrun)
+
+def _is_auth_error(e: Exception) -> bool:
+    from garth.exc import GarthException, GarthHTTPError
+
+    if isinstance(e, GarthHTTPError):
+        return e.error.response is not None and e.error.response.status_code in (401, 403)
+    return isinstance(e, GarthException)
+
+def upload_file(f: IO[bytes], original_path: Optional[Path] = None, dryrun: bool = False):
+    import garth
+    from garth.exc import GarthException, GarthHTTPError
+
+    global _garth_ready
+    _ensure_garth()
+    try:
+        if not dryrun:
+            upload_limiter.wait()
+            try:
                 upload_result = garth.client.upload(f)
-            _logger.info(f':white_check_mark: Successfully uploaded "{str(original_path)}"')
-            return upload_result
-        except GarthHTTPError as e:
-            if e.error.response.status_code == 409:
-                _logger.warning(f":x: Received HTTP conflict (activity already exists) for \"{str(original_path)}\"")
-            else:
-                raise e
+            except GarthException as e:
+                if not _is_auth_error(e):
+                    raise
+                # the stored session has expired or been revoked, log in again and retry once
+                _logger.info(f"Garmin Connect session rejected while uploading \"{str(original_path)}\", re-authenticating")
+                _garth_ready = False
+                _ensure_garth()
+                f.seek(0)
+                upload_limiter.wait()
+                upload_result = garth.client.upload(f)
+        _logger.info(f':white_check_mark: Successfully uploaded "{str(original_path)}"')
+        return upload_result
+    except GarthHTTPError as e:
+        if e.error.response.status_code == 409:
+            _logger.warning(f":x: Received HTTP conflict (activity already exists) for \"{str(original_path)}\"")
+        else:
+            raise e
     
+def upload_modified_data(data: bytes, f: str, dryrun: bool = False):
+    # garth uploads using the name of the file object, so write to a named temporary file and
+    # upload from the same handle rather than reopening it
+    with NamedTemporaryFile(delete=True) as fp:
+        fp.write(data)
+        fp.flush()
+        fp.seek(0)
+        _logger.info(f"Uploading modified \"{f}\" to Garmin Connect")
+        try:
+            return upload_file(fp, original_path=Path(f), dryrun=dryrun)
+        except Exception as e:
+            # log as soon as it happens, upload_all only counts failures once the batch is done
+            _logger.error(f":x: Failed to upload \"{f}\"", exc_info=e)
+            raise
+
 def upload_all(dir: Path, preinitialise: bool = False, dryrun: bool = False):
     files_uploaded = dir.joinpath(FILES_UPLOADED_NAME)
     if files_uploaded.exists():
@@ -226,16 +365,17 @@ def upload_all(dir: Path, preinitialise: bool = False, dryrun: bool = False):
             # write blank file
             json.dump(uploaded_files, f, indent=2)
     _logger.debug(f"Found the following already uploaded files: {uploaded_files}")
+    uploaded_set = set(uploaded_files)
+    uploaded_count = len(uploaded_files)
     abs_dir = str(dir.absolute())
     
-    # glob all .fit files in the current directory
-    files = [str(i) for i in dir.glob('*.fit', case_sensitive=False)]
-    # strip any leading/trailing slashes from filenames
-    files = [i.replace(str(dir), '').strip('/').strip('\\') for i in files]
-    # remove files matching what we may have already processed
-    files = [i for i in files if not i.endswith('_modified.fit')]
-    # remove files found in the "already uploaded" list
-    files = [i for i in files if not i in uploaded_files]
+    # find all .fit files in the current directory, skipping hidden files, files matching what we
+    # may have already processed and files found in the "already uploaded" list
+    with os.scandir(dir) as entries:
+        files = [e.name for e in entries
+                 if e.name.lower().endswith('.fit') and not e.name.startswith('.')
+                 and not e.name.endswith('_modified.fit') and e.name not in uploaded_set
+                 and e.is_file()]
     
     _logger.info(f"Found {len(files)} files to edit/upload")
     _logger.debug(f"Files to upload: {files}")
@@ -243,44 +383,80 @@ def upload_all(dir: Path, preinitialise: bool = False, dryrun: bool = False):
     if not files:
         return
     
-    for f in files:
-        _logger.info(f"Processing \"{f}\"")  # type: ignore
-        
-        if not preinitialise:
-            with NamedTemporaryFile(delete=True, delete_on_close=False) as fp:
-                #try:
-                    output = edit_fit(dir.joinpath(f), output=Path(fp.name))
-                    _logger.info(f"Uploading modified file to Garmin Connect")
-                    res = upload(output, original_path=Path(f), dryrun=dryrun)
-                    _logger.debug(f"Adding \"{f}\" to \"uploaded_files\"")
-                #except:
-                #    _logger.warning(f"Failed  to modify file \"{f}\", possibly malformed FIT file.")
-        uploaded_files.append(f)    
-
-    if not dryrun:
-        with files_uploaded.open('w') as f:
-            json.dump(uploaded_files, f, indent=2)
+    failures = 0
+    uploads = []
+    try:
+        if preinitialise:
+            uploaded_files.extend(files)
+        else:
+            # authenticate up front so worker threads never prompt for credentials
+            _ensure_garth()
+            executor = ThreadPoolExecutor(max_workers=MAX_UPLOAD_WORKERS)
+            try:
+                for f in files:
+                    # edit files on this thread so the log output for each file stays together,
+                    # only the uploads run in the pool
+                    _logger.info(f"Processing \"{f}\"")  # type: ignore
+                    try:
+                        data, dt = build_modified_fit(dir.joinpath(f), require_file_id=True)
+                    except Exception as e:
+                        _logger.error(f":x: Failed to edit \"{f}\"", exc_info=e)
+                        failures += 1
+                        continue
+                    if dt is None:
+                        _logger.warning(f":x: No file id message found in \"{f}\", possibly malformed FIT file, skipping upload")
+                        continue
+                    uploads.append((f, executor.submit(upload_modified_data, data, f, dryrun)))
+                wait([future for f, future in uploads])
+            except BaseException:
+                # e.g. a keyboard interrupt, don't start any queued files but let running uploads finish
+                executor.shutdown(cancel_futures=True)
+                raise
+            executor.shutdown()
+    finally:
+        # record every file that finished uploading, even if another file failed or the run was interrupted
+        for f, future in uploads:
+            if not future.done() or future.cancelled():
+                continue
+            if future.exception():
+                failures += 1
+            else:
+                _logger.debug(f"Adding \"{f}\" to \"uploaded_files\"")
+                uploaded_files.append(f)
+        # skip the rewrite if nothing new was recorded
+        if not dryrun and len(uploaded_files) > uploaded_count:
+            with files_uploaded.open('w') as fp:
+                json.dump(uploaded_files, fp, indent=2)
+    if failures:
+        # each failure has already been logged with its traceback
+        raise RuntimeError(f"{failures} of {len(files)} files failed to edit or upload") from None
 
 def daemonise(watch_dir: Path):
+    from watchfiles import watch
+
     email = os.environ.get('GARMIN_USERNAME', None)
     password = os.environ.get('GARMIN_PASSWORD', None)
     if not email or not password:
         _logger.error('Your environment has not specified your Garmin credentials. For the daemon mode to work these must be available as environment variables in your system, or stored in a local environment file.')
         sys.exit(1)
         
-    event_handler = NewFileEventHandler()
-    observer = Observer()
-    observer.schedule(event_handler, watch_dir, recursive=False)
-    observer.start()
-    _logger.info(f"Monitoring directory: {watch_dir.absolute()}")
-    try:
-        while True:
-            time.sleep(300)
-    except KeyboardInterrupt as e:
+    stop_event = threading.Event()
+    def on_interrupt(signum, frame):
         _logger.info(f"Received keyboard interrupt, shutting down monitor")
-    finally:
-        observer.stop()
-        observer.join()
+        stop_event.set()
+        # a second ctrl-c raises KeyboardInterrupt as usual, e.g. to abandon a slow or hung upload
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+    signal.signal(signal.SIGINT, on_interrupt)
+
+    _logger.info(f"Monitoring directory: {watch_dir.absolute()}")
+    # blocks until new files arrive or the stop event is set
+    for changes in watch(watch_dir, watch_filter=new_fit_file_filter, stop_event=stop_event, recursive=False):
+        for change, path in changes:
+            _logger.debug("New file created - % s." % path)
+        # Wait for a short time to make sure TPV has finished writing to the file
+        time.sleep(5)
+        # Run the upload all function
+        upload_all(watch_dir.absolute())
 
 if __name__ == '__main__':    
     parser = argparse.ArgumentParser(description="Tool to add Garmin device information to FIT files and upload them to Garmin Connect")
@@ -315,7 +491,7 @@ if __name__ == '__main__':
             logging.getLogger(l).setLevel(logging.WARNING)
     if not CONFIG_FILE.is_file():
         first_run()
-    config = yaml.safe_load(open(CONFIG_FILE))
+    config = load_config()
     TPVFolder = get_tpv_folder()
     if args.upload_all or args.preinitialise:
         if not args.input_file:
@@ -332,6 +508,9 @@ if __name__ == '__main__':
         daemonise(Path(watch_dir))
     else:
         p = Path(args.input_file)
-        output_path = edit_fit(p, dryrun=args.dryrun)
+        output_path, dt = edit_fit(p, dryrun=args.dryrun)
         if args.upload:
-            upload(output_path, original_path=p, dryrun=args.dryrun)
+            if dt is None:
+                _logger.warning(f":x: No file id message found in \"{p}\", possibly malformed FIT file, skipping upload")
+            else:
+                upload(output_path, original_path=p, dryrun=args.dryrun)